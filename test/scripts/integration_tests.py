@@ -17,25 +17,60 @@ Module used to perform integration testing on lostromos, by attempting multiple
 kubectl.
 """
 
+import json
 import os
-import re
+import pathlib
 import time
 import requests
 import signal
+import socket
 import subprocess
 
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client.parser import text_string_to_metric_families
+from requests.adapters import HTTPAdapter
 from unittest import TestCase
 
-_LOSTROMOS_EXE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "lostromos")
-_TEST_DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
-_LOSTROMOS_CONFIGURATION_FILE = os.path.join(_TEST_DATA_DIRECTORY, "config.yaml")
-_CUSTOM_RESOURCE_DEFINITION_FILE = os.path.join(_TEST_DATA_DIRECTORY, "crd.yml")
-_THINGS_CUSTOM_RESOURCE_FILE = os.path.join(_TEST_DATA_DIRECTORY, "cr_things.yml")
-_THINGS_FILTERED_CUSTOM_RESOURCE_FILE = os.path.join(_TEST_DATA_DIRECTORY, "cr_things_filter.yml")
-_THINGS_FILTERED_UPDATE_CUSTOM_RESOURCE_FILE = os.path.join(_TEST_DATA_DIRECTORY, "cr_things_filter_update.yml")
-_NEMO_CUSTOM_RESOURCE_FILE = os.path.join(_TEST_DATA_DIRECTORY, "cr_nemo.yml")
-_NEMO_UPDATE_CUSTOM_RESOURCE_FILE = os.path.join(_TEST_DATA_DIRECTORY, "cr_nemo_update.yml")
-_REMOTE_REPO_CUSTOM_RESOURCE_FILE = os.path.join(_TEST_DATA_DIRECTORY, "cr_remote_repo.yml")
+_SCRIPTS_DIRECTORY = pathlib.Path(__file__).resolve().parent
+_TEST_DATA_DIRECTORY = _SCRIPTS_DIRECTORY.parent / "data"
+_LOSTROMOS_EXE = str(_SCRIPTS_DIRECTORY.parent.parent / "lostromos")
+_LOSTROMOS_CONFIGURATION_FILE = str(_TEST_DATA_DIRECTORY / "config.yaml")
+_HELM_CONFIGURATION_FILE = str(_TEST_DATA_DIRECTORY / "helm" / "wait-config.yaml")
+_CUSTOM_RESOURCE_DEFINITION_FILE = str(_TEST_DATA_DIRECTORY / "crd.yml")
+_TILLER_NODEPORT_SERVICE_FILE = str(_TEST_DATA_DIRECTORY / "tiller_nodeport_service.yml")
+_THINGS_CUSTOM_RESOURCE_FILE = str(_TEST_DATA_DIRECTORY / "cr_things.yml")
+_THINGS_FILTERED_CUSTOM_RESOURCE_FILE = str(_TEST_DATA_DIRECTORY / "cr_things_filter.yml")
+_THINGS_FILTERED_UPDATE_CUSTOM_RESOURCE_FILE = str(_TEST_DATA_DIRECTORY / "cr_things_filter_update.yml")
+_NEMO_CUSTOM_RESOURCE_FILE = str(_TEST_DATA_DIRECTORY / "cr_nemo.yml")
+_NEMO_UPDATE_CUSTOM_RESOURCE_FILE = str(_TEST_DATA_DIRECTORY / "cr_nemo_update.yml")
+_REMOTE_REPO_CUSTOM_RESOURCE_FILE = str(_TEST_DATA_DIRECTORY / "cr_remote_repo.yml")
+_TILLER_NODE_PORT = 32664
+# Release status codes as reported by Helm 2's `helm status --output json`
+_HELM_STATUS_DEPLOYED = 1
+_HELM_STATUS_FAILED = 4
+
+
+def _wait_until(predicate, timeout, initial_interval=0.05, max_interval=0.5):
+    """
+    Poll a predicate until it returns something other than None, backing off exponentially between attempts so that
+    fast changes are seen quickly without hammering whatever is being polled.
+    :param predicate: Function taking no arguments, returning None until the awaited condition is met.
+    :param timeout: Number of seconds to keep polling for.
+    :param initial_interval: Number of seconds to sleep after the first unsuccessful attempt.
+    :param max_interval: Maximum number of seconds to sleep between attempts.
+    :return: The first value returned by the predicate that isn't None, or None if the timeout was reached.
+    """
+    deadline = time.monotonic() + timeout
+    interval = initial_interval
+    while True:
+        value = predicate()
+        if value is not None:
+            return value
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 1.5, max_interval)
 
 
 class Kubectl(object):
@@ -43,38 +78,85 @@ class Kubectl(object):
     Class used to interact with kubectl and return data.
     """
 
-    def __run_command(self, command, filepath, raise_error):
+    def __run_command(self, command, filepaths, raise_error, ignore_not_found=False):
         """
-        Run a command via kubectl.  Will raise an error if the command fails.
+        Run a command via kubectl.  Will raise an error if the command fails. When given multiple files, they are
+        joined into a single multi-document manifest and sent through one kubectl invocation. Should that fail, each
+        file is retried on its own, concurrently, so a single bad manifest doesn't abort the rest.
         :param command: The command to run.
-        :param filepath: The path to the file to use for the command.
+        :param filepaths: The path, or list of paths, to the files to use for the command.
         :param raise_error: Whether to raise the error should one occur. If False any error is swallowed.
+        :param ignore_not_found: Whether a delete should skip resources that don't exist. Always the case when errors
+            are swallowed.
+        """
+        if isinstance(filepaths, str):
+            filepaths = [filepaths]
+        arguments = ["kubectl", command]
+        if command == "delete" and (ignore_not_found or not raise_error):
+            # Missing resources are expected when cleaning up, and would otherwise fail the whole batch.
+            arguments.append("--ignore-not-found")
+        if len(filepaths) == 1:
+            arguments += ["-f", filepaths[0]]
+            manifest = None
+        else:
+            arguments += ["-f", "-"]
+            manifest = self.__bundle(filepaths)
+        # kubectl's own output isn't used, and only the errors are worth reporting
+        result = subprocess.run(
+            arguments,
+            input=manifest,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            close_fds=True,
+            check=False
+        )
+        if result.returncode == 0:
+            return
+        error = subprocess.CalledProcessError(result.returncode, arguments, stderr=result.stderr)
+        if len(filepaths) > 1:
+            # The files don't depend on each other, so there is no need to wait on each round trip in turn. Part of
+            # the batch may already have been deleted, which shouldn't be reported as a failure on the retry.
+            with ThreadPoolExecutor(max_workers=len(filepaths)) as executor:
+                futures = [
+                    executor.submit(self.__run_command, command, filepath, raise_error, True)
+                    for filepath in filepaths
+                ]
+            for future in futures:
+                try:
+                    future.result()
+                except subprocess.CalledProcessError as file_error:
+                    # Keep the batch failure, and its stderr, attached to the error that is raised
+                    raise file_error from error
+        elif raise_error:
+            raise error
+
+    @staticmethod
+    def __bundle(filepaths):
         """
-        try:
-            subprocess.check_call([
-                "kubectl",
-                command,
-                "-f",
-                filepath
-            ])
-        except subprocess.CalledProcessError as error:
-            if raise_error:
-                raise error
+        Join the given manifests into a single multi-document manifest.
+        :param filepaths: The paths to the files to join.
+        :return: The joined manifests as bytes.
+        """
+        manifests = []
+        for filepath in filepaths:
+            with open(filepath, "rb") as manifest:
+                manifests.append(manifest.read())
+        return b"\n---\n".join(manifests)
 
-    def apply(self, filepath):
+    def apply(self, filepaths):
         """
-        Run an apply with the given filepath. Will raise an error if the command fails.
-        :param filepath: The file to be used for the given apply.
+        Run an apply with the given filepaths. Will raise an error if the command fails.
+        :param filepaths: The file, or list of files, to be used for the given apply.
         """
-        self.__run_command("apply", filepath, True)
+        self.__run_command("apply", filepaths, True)
 
-    def delete(self, filepath, raise_error=False):
+    def delete(self, filepaths, raise_error=False):
         """
-        Run a delete with the given filepath. Will raise an error if the command fails.
-        :param filepath: The file to be used for the given delete.
+        Run a delete with the given filepaths. Will raise an error if the command fails.
+        :param filepaths: The file, or list of files, to be used for the given delete.
         :param raise_error: Whether or not to smother the error.
         """
-        self.__run_command("delete", filepath, raise_error)
+        self.__run_command("delete", filepaths, raise_error)
 
 
 class Helm(object):
@@ -109,21 +191,29 @@ class Helm(object):
 
     def status(self, release_name):
         """
-        Return the output of helm status
+        Return the status code of a release, read from the json output of helm status
         :param release_name: The name of the release to get
-        :return: The output of command as bytes
+        :return: The status code as an int, or None if the release status couldn't be retrieved
         """
         try:
-            output = subprocess.check_output(
+            result = subprocess.run(
                 [
                     "helm",
                     "status",
-                    release_name
-                ]
+                    release_name,
+                    "--output",
+                    "json"
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                check=False,
+                timeout=5
             )
-            return output
-        except subprocess.CalledProcessError as error:
-            return error.output
+        except subprocess.TimeoutExpired:
+            return None
+        if result.returncode != 0:
+            return None
+        return json.loads(result.stdout.decode("utf-8"))["info"]["status"].get("code", 0)
 
 
 class HelmIntegrationTest(TestCase):
@@ -132,19 +222,31 @@ class HelmIntegrationTest(TestCase):
     manipulate the kubernetes system and helm to interact with helm.
     """
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
         """
-        Ensure the custom resource definition exists, and set up Helm.
+        Ensure the custom resource definition exists, and set up Helm. Done once for all tests in the class, as the
+        helm init in particular is slow.
         """
-
-        self.__kubectl = Kubectl()
+        cls.__kubectl = Kubectl()
         # Set up the tiller and expose it via a nodeport service
-        self.__helm = Helm()
-        self.__helm.init()
-        self.__kubectl.apply(_TEST_DATA_DIRECTORY + "/tiller_nodeport_service.yml")
-        self.__kubectl.apply(_CUSTOM_RESOURCE_DEFINITION_FILE)
+        cls.__helm = Helm()
+        cls.__helm.init()
+        cls.__kubectl.apply([_TILLER_NODEPORT_SERVICE_FILE, _CUSTOM_RESOURCE_DEFINITION_FILE])
+        cls.__minikube_ip = subprocess.check_output(["minikube", "ip"]).strip().decode("utf-8")
+
+    @classmethod
+    def tearDownClass(cls):
+        """
+        Remove the custom resource definition.
+        """
+        cls.__kubectl.delete(_CUSTOM_RESOURCE_DEFINITION_FILE)
+
+    def setUp(self):
+        """
+        Ensure there is no nemo custom resource, for a clean starting point.
+        """
         self.__kubectl.delete(_NEMO_CUSTOM_RESOURCE_FILE)
-        self.__minikube_ip = subprocess.check_output(["minikube", "ip"]).strip().decode('utf-8')
 
     def runTest(self):
         """
@@ -156,14 +258,13 @@ class HelmIntegrationTest(TestCase):
                 _LOSTROMOS_EXE,
                 "start",
                 "--config",
-                _TEST_DATA_DIRECTORY + "/helm/wait-config.yaml",
+                _HELM_CONFIGURATION_FILE,
                 "--helm-tiller",
-                self.__minikube_ip + ":32664",
+                "{}:{}".format(self.__minikube_ip, _TILLER_NODE_PORT),
             ],
         )
         print("Started Lostromos with PID: {}".format(self.__lostromos_process.pid))
-        # Sleep for a bit until the tiller is available
-        time.sleep(15)
+        self.__wait_for_tiller(15)
         self.__kubectl.apply(_NEMO_CUSTOM_RESOURCE_FILE)
         self.__wait_for_helm_to_fail(15)
 
@@ -171,36 +272,46 @@ class HelmIntegrationTest(TestCase):
         """
         Kill the lostromos process if it was created.
         """
-        self.__kubectl.delete(_CUSTOM_RESOURCE_DEFINITION_FILE)
         self.__helm.delete("lostromos-nemo")
         if self.__lostromos_process:
             self.__lostromos_process.send_signal(signal.SIGINT)
 
+    def __wait_for_tiller(self, timeout):
+        """
+        Wait for the tiller to accept connections on its nodeport, then return.
+        :param timeout: Number of seconds to wait for the tiller to become available.
+        """
+        def tiller_available():
+            try:
+                socket.create_connection((self.__minikube_ip, _TILLER_NODE_PORT), timeout=0.5).close()
+            except OSError:
+                return None
+            return True
+
+        if _wait_until(tiller_available, timeout) is None:
+            raise AssertionError("Tiller is not available")
+
     def __wait_for_helm_to_fail(self, timeout):
         """
         Wait for the helm timeout to be reached and verify the release is marked as failed
         :return:
         """
-        seconds_to_sleep = 1
         # Check that the release wasn't immediately marked as failed or successful
 
-        output = self.__helm.status("lostromos-nemo")
-        self.assertNotIn(
-            "STATUS: FAILED",
-            output.decode("utf-8"),
+        status = self.__helm.status("lostromos-nemo")
+        self.assertNotEqual(
+            status,
+            _HELM_STATUS_FAILED,
             "Helm release is FAILED but did not wait for the timeout"
         )
-        self.assertNotIn("STATUS: DEPLOYED", output.decode("utf-8"), "Helm release is DEPLOYED but should be FAILED")
+        self.assertNotEqual(status, _HELM_STATUS_DEPLOYED, "Helm release is DEPLOYED but should be FAILED")
 
-        while timeout > 0:
-            try:
-                output = self.__helm.status("lostromos-nemo")
-                self.assertIn("STATUS: FAILED", output.decode("utf-8"))
-                return
-            except AssertionError:
-                time.sleep(1)
-                timeout -= seconds_to_sleep
-        raise AssertionError("Helm release not marked as failed")
+        def release_failed():
+            return True if self.__helm.status("lostromos-nemo") == _HELM_STATUS_FAILED else None
+
+        # Each status check forks helm, so poll at a steady second rather than backing off from a short interval
+        if _wait_until(release_failed, timeout, initial_interval=1, max_interval=1) is None:
+            raise AssertionError("Helm release not marked as failed")
 
 
 class TemplateIntegrationTestWithFiltering(TestCase):
@@ -209,20 +320,37 @@ class TemplateIntegrationTestWithFiltering(TestCase):
     kubernetes system.
     """
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
         """
-        Ensure the custom resource definition exists, and set up the status and metrics url.
+        Ensure the custom resource definition exists. Done once for all tests in the class.
         """
-        self.__kubectl = Kubectl()
+        cls.__kubectl = Kubectl()
+        cls.__kubectl.apply(_CUSTOM_RESOURCE_DEFINITION_FILE)
 
-        # Ensure the CRD is there and there are no characters, for a clean starting point
-        self.__kubectl.apply(_CUSTOM_RESOURCE_DEFINITION_FILE)
-        self.__kubectl.delete(_THINGS_CUSTOM_RESOURCE_FILE)
-        self.__kubectl.delete(_THINGS_FILTERED_CUSTOM_RESOURCE_FILE)
-        self.__kubectl.delete(_THINGS_FILTERED_UPDATE_CUSTOM_RESOURCE_FILE)
-        self.__kubectl.delete(_NEMO_CUSTOM_RESOURCE_FILE)
-        self.__kubectl.delete(_NEMO_UPDATE_CUSTOM_RESOURCE_FILE)
+    @classmethod
+    def tearDownClass(cls):
+        """
+        Remove the custom resource definition.
+        """
+        cls.__kubectl.delete(_CUSTOM_RESOURCE_DEFINITION_FILE)
+
+    def setUp(self):
+        """
+        Ensure there are no characters, for a clean starting point, and set up the status and metrics url.
+        """
+        self.__kubectl.delete([
+            _THINGS_CUSTOM_RESOURCE_FILE,
+            _THINGS_FILTERED_CUSTOM_RESOURCE_FILE,
+            _THINGS_FILTERED_UPDATE_CUSTOM_RESOURCE_FILE,
+            _NEMO_CUSTOM_RESOURCE_FILE,
+            _NEMO_UPDATE_CUSTOM_RESOURCE_FILE,
+            _REMOTE_REPO_CUSTOM_RESOURCE_FILE,
+        ])
         self.__lostromos_process = None
+        # Reuse connections to Lostromos across the many status and metrics polls
+        self.__http = requests.Session()
+        self.__http.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
         self.__status_url = "http://localhost:8080/status"
         self.__metrics_url = "http://localhost:8080/metrics"
 
@@ -330,7 +458,7 @@ class TemplateIntegrationTestWithFiltering(TestCase):
         """
         Kill the lostromos process if it was created.
         """
-        self.__kubectl.delete(_CUSTOM_RESOURCE_DEFINITION_FILE)
+        self.__http.close()
         if self.__lostromos_process:
             self.__lostromos_process.send_signal(signal.SIGINT)
 
@@ -345,23 +473,11 @@ class TemplateIntegrationTestWithFiltering(TestCase):
         :param deleted: Number of resources we expect Lostromos to have deleted.
         :param updated: Number of resources we expect Lostromos to have updated.
         """
-        metrics = []
-        attempts = 10
-        while attempts > 0:
-            metrics_response = requests.get(self.__metrics_url)
-            metrics_response.raise_for_status()
-            metrics = metrics_response.text.split("\n")
-            if "releases_events_total {}".format(events) not in metrics:
-                time.sleep(1)
-                attempts -= 1
-            else:
-                self.assertIn("releases_total {}".format(managed), metrics)
-                self.assertIn("releases_create_total {}".format(created), metrics)
-                self.assertIn("releases_delete_total {}".format(deleted), metrics)
-                self.assertIn("releases_update_total {}".format(updated), metrics)
-                return
-
-        raise AssertionError("Failed to see the expected number of events. {}".format(metrics))
+        metrics = self.__wait_for_events(events)
+        self.assertEqual(metrics.get(("releases_total", ())), managed)
+        self.assertEqual(metrics.get(("releases_create_total", ())), created)
+        self.assertEqual(metrics.get(("releases_delete_total", ())), deleted)
+        self.assertEqual(metrics.get(("releases_update_total", ())), updated)
 
     def __check_timestamp(self, metric, timestamp, num_events):
         """
@@ -370,22 +486,44 @@ class TemplateIntegrationTestWithFiltering(TestCase):
         :param timestamp: timestamp to compare metric
         :param num_events: expected number of events
         """
-        attempts = 10
-        while attempts > 0:
-            metrics_response = requests.get(self.__metrics_url)
-            metrics_response.raise_for_status()
-            metrics = metrics_response.text.split("\n")
-            if "releases_events_total {}".format(num_events) not in metrics:
-                time.sleep(1)
-                attempts -= 1
-            else:
-                for line in metrics:
-                    if re.match(metric, line):
-                        metric_ts = line.split(" ")[1]
-                        self.assertTrue(float(metric_ts) > timestamp)
-                        return
-                raise AssertionError("Failed to find metric {}".format(metric))
-        raise AssertionError("Failed to see the expected number of events. {}".format(metrics))
+        metrics = self.__wait_for_events(num_events)
+        self.assertIn((metric, ()), metrics, "Failed to find metric {}".format(metric))
+        self.assertGreater(metrics[(metric, ())], timestamp, "Metric {} is not after the action".format(metric))
+
+    def __wait_for_events(self, events):
+        """
+        Wait up to 10 seconds for Lostromos to report the expected amount of events. If the events haven't occurred,
+        then an assertionError will be raised.
+        :param events: Number of events we are expecting to have happened.
+        :return: The metrics snapshot in which the events were seen.
+        """
+        last_metrics = {}
+
+        def snapshot_with_events():
+            nonlocal last_metrics
+            # Keep the latest snapshot around so a failure reports what was actually checked
+            last_metrics = self.__snapshot_metrics()
+            if last_metrics.get(("releases_events_total", ())) == events:
+                return last_metrics
+            return None
+
+        metrics = _wait_until(snapshot_with_events, 10)
+        if metrics is None:
+            raise AssertionError("Failed to see the expected number of events. {}".format(last_metrics))
+        return metrics
+
+    def __snapshot_metrics(self):
+        """
+        Fetch the metrics exposition from Lostromos and parse it once, so each check is a single lookup.
+        :return: A dict of (sample name, sorted label pairs) to the sample value as a float.
+        """
+        metrics_response = self.__http.get(self.__metrics_url, timeout=2)
+        metrics_response.raise_for_status()
+        return {
+            (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+            for family in text_string_to_metric_families(metrics_response.text)
+            for sample in family.samples
+        }
 
     def __wait_for_lostromos_start(self):
         """
@@ -394,15 +532,15 @@ class TemplateIntegrationTestWithFiltering(TestCase):
         # 15 seconds is probably more than we need, but the main use of these tests will be to run in TravisCI, and
         # since we don't control that infrastructure it makes sense to inflate the value a bit. An extra 10 seconds
         # should cause no harm, but help out in cases where the Travis servers are overwhelmed.
-        seconds_to_wait = 15
-        seconds_to_sleep = 1
-        while seconds_to_wait > 0:
+        def started():
             try:
-                status_response = requests.get(self.__status_url)
-                status_response.raise_for_status()
-                self.assertTrue(status_response.json()["success"])
-            except requests.exceptions.ConnectionError:
-                time.sleep(seconds_to_sleep)
-                seconds_to_wait -= seconds_to_sleep
+                # Fail fast on each attempt, Lostromos is on localhost and either answers quickly or not at all
+                status_response = self.__http.get(self.__status_url, timeout=0.5)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                return None
+            status_response.raise_for_status()
+            return status_response.json()["success"] or None
+
+        if _wait_until(started, 15):
             return
         raise AssertionError("Failed to start Lostromos.")